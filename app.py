@@ -1,11 +1,20 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.ticker import PercentFormatter
-from lifelines import KaplanMeierFitter
-from lifelines.statistics import logrank_test
 from datetime import datetime
 
+from km_pipeline import (
+    ajustar_km,
+    ajustar_km_global,
+    carregar_dados,
+    eixo_percent,
+    eixo_prob,
+    exibir_figura,
+    grafico_km,
+    logrank_por_desfecho,
+    sobrevida_em,
+)
+
 st.set_page_config(
     page_title="Kaplan-Meier – Transplante Renal",
     layout="wide"
@@ -16,41 +25,40 @@ uploaded_file = st.secrets['DATABASE']
 
 if uploaded_file:
 
-    df = pd.read_csv(uploaded_file)
-
-    # ================= TRATAMENTO DE DATAS =================
-    for col in ["data_tx", "data_obito", "data_pe"]:
-        df[col] = pd.to_datetime(df[col], errors="coerce")
-
-    df["ano_tx"] = df["data_tx"].dt.year
     data_censura = pd.to_datetime(datetime.today().date())
-
-    # ================= EVENTOS =================
-    df["evento_obito"] = df["data_obito"].notna().astype(int)
-    df["tempo_obito"] = (
-        df["data_obito"].fillna(data_censura) - df["data_tx"]
-    ).dt.days
-
-    df["evento_pe"] = df["data_pe"].notna().astype(int)
-    df["tempo_pe"] = (
-        df["data_pe"].fillna(data_censura) - df["data_tx"]
-    ).dt.days
-
-    df["tempo_obito_anos"] = df["tempo_obito"] / 365.25
-    df["tempo_pe_anos"] = df["tempo_pe"] / 365.25
-
-    anos = sorted(df["ano_tx"].dropna().unique())
-
-    tabela_resumo = (
-        df.groupby("ano_tx")
-        .agg(
-            total_transplantes=("ano_tx", "count"),
-            obitos=("evento_obito", "sum"),
-            perda_enxerto=("evento_pe", "sum")
-        )
-        .reset_index()
-        .sort_values("ano_tx")
-    )
+    df = carregar_dados(uploaded_file, data_censura)
+
+    ano_tx = df["ano_tx"].to_numpy()
+    tem_ano = ~np.isnan(ano_tx)
+    anos = tuple(int(ano) for ano in np.unique(ano_tx[tem_ano]))
+    com_ano = df[tem_ano]
+
+    if not anos:
+        st.warning("Nenhum transplante com data_tx válida no arquivo.")
+        st.stop()
+
+    # arrays contíguos por ano, convertidos uma vez para todos os ajustes
+    estratos = {
+        int(ano): {col: sub[col].to_numpy() for col in [
+            "tempo_obito_anos", "evento_obito", "tempo_pe_anos", "evento_pe"
+        ]}
+        for ano, sub in com_ano.groupby("ano_tx")
+    }
+
+    # poucos anos distintos: contagem por deslocamento a partir do primeiro
+    desloc = (ano_tx[tem_ano] - anos[0]).astype(np.int64)
+    linhas_ano = (np.asarray(anos) - anos[0]).astype(np.int64)
+
+    tabela_resumo = pd.DataFrame({
+        "ano_tx": anos,
+        "total_transplantes": np.bincount(desloc)[linhas_ano],
+        "obitos": np.bincount(
+            desloc, weights=com_ano["evento_obito"]
+        )[linhas_ano].astype(np.int64),
+        "perda_enxerto": np.bincount(
+            desloc, weights=com_ano["evento_pe"]
+        )[linhas_ano].astype(np.int64),
+    })
 
     tabela_resumo["taxa_obito_%"] = (
         tabela_resumo["obitos"] / tabela_resumo["total_transplantes"] * 100
@@ -63,69 +71,58 @@ if uploaded_file:
     st.subheader("Resumo de Eventos por Ano do Transplante")
     st.dataframe(tabela_resumo, use_container_width=True)
 
-    comparacoes = [(a1, a2) for i, a1 in enumerate(anos)
-                   for a2 in anos[i+1:]]
+    # índices na ordem de `anos`, a mesma das linhas da matriz de p-valores
+    comparacoes = [(i, k) for i in range(len(anos))
+                   for k in range(i + 1, len(anos))]
+
+    p_obito, p_pe = logrank_por_desfecho(com_ano)
 
     st.subheader("Comparação Estatística – Óbito (Log-rank)")
     resultados_obito = []
 
-    for a1, a2 in comparacoes:
-        d1 = df[df["ano_tx"] == a1]
-        d2 = df[df["ano_tx"] == a2]
-
-        if len(d1) > 0 and len(d2) > 0:
-            res = logrank_test(
-                d1["tempo_obito_anos"], d2["tempo_obito_anos"],
-                event_observed_A=d1["evento_obito"],
-                event_observed_B=d2["evento_obito"]
-            )
-            resultados_obito.append({
-                "Comparação": f"{a1} x {a2}",
-                "p-valor": round(res.p_value, 4)
-            })
+    for i, k in comparacoes:
+        resultados_obito.append({
+            "Comparação": f"{anos[i]} x {anos[k]}",
+            "p-valor": round(p_obito[i, k], 4)
+        })
 
     st.dataframe(pd.DataFrame(resultados_obito), use_container_width=True)
 
     st.subheader("Comparação Estatística – Perda de Enxerto (Log-rank)")
     resultados_pe = []
 
-    for a1, a2 in comparacoes:
-        d1 = df[df["ano_tx"] == a1]
-        d2 = df[df["ano_tx"] == a2]
-
-        if len(d1) > 0 and len(d2) > 0:
-            res = logrank_test(
-                d1["tempo_pe_anos"], d2["tempo_pe_anos"],
-                event_observed_A=d1["evento_pe"],
-                event_observed_B=d2["evento_pe"]
-            )
-            resultados_pe.append({
-                "Comparação": f"{a1} x {a2}",
-                "p-valor": round(res.p_value, 4)
-            })
+    for i, k in comparacoes:
+        resultados_pe.append({
+            "Comparação": f"{anos[i]} x {anos[k]}",
+            "p-valor": round(p_pe[i, k], 4)
+        })
 
     st.dataframe(pd.DataFrame(resultados_pe), use_container_width=True)
 
     st.subheader("Sobrevida do Paciente em 1, 2 e 5 anos")
 
-    linhas = []
-    for ano in anos:
-        dados = df[df["ano_tx"] == ano]
-        if len(dados) > 0:
-            kmf = KaplanMeierFitter()
-            kmf.fit(dados["tempo_obito_anos"], dados["evento_obito"])
-            linhas.append({
-                "Ano": ano,
-                "1 ano (%)": round(kmf.predict(1) * 100, 1),
-                "2 anos (%)": round(kmf.predict(2) * 100, 1),
-                "5 anos (%)": round(kmf.predict(5) * 100, 1),
-            })
-
-    st.dataframe(pd.DataFrame(linhas), use_container_width=True)
-
-    total_global = len(df)
-    total_obitos = df["evento_obito"].sum()
-    total_pe = df["evento_pe"].sum()
+    # matriz anos x horizontes (1, 2 e 5 anos), montada de uma vez
+    sobrevida_horizontes = np.array([
+        sobrevida_em(*ajustar_km(estratos[ano]["tempo_obito_anos"],
+                                 estratos[ano]["evento_obito"]),
+                     [1, 2, 5])
+        for ano in anos
+    ]) * 100
+
+    tabela_sobrevida = pd.DataFrame({
+        "Ano": anos,
+        "1 ano (%)": sobrevida_horizontes[:, 0].round(1),
+        "2 anos (%)": sobrevida_horizontes[:, 1].round(1),
+        "5 anos (%)": sobrevida_horizontes[:, 2].round(1),
+    })
+
+    st.dataframe(tabela_sobrevida, use_container_width=True)
+
+    # coorte global: só transplantes com data_tx válida, como nas demais
+    # tabelas e nos ajustes por ano
+    total_global = len(com_ano)
+    total_obitos = com_ano["evento_obito"].sum()
+    total_pe = com_ano["evento_pe"].sum()
 
     tabela_global = pd.DataFrame({
         "Total Transplantes": [total_global],
@@ -138,112 +135,57 @@ if uploaded_file:
     st.subheader("Análise Global da Coorte")
     st.dataframe(tabela_global, use_container_width=True)
 
-    kmf_global_obito = KaplanMeierFitter()
-    kmf_global_obito.fit(df["tempo_obito_anos"], df["evento_obito"], label="Global")
+    kmf_global_obito = ajustar_km_global(
+        com_ano["tempo_obito"].to_numpy().tobytes(),
+        com_ano["evento_obito"].to_numpy().tobytes()
+    )
 
-    kmf_global_pe = KaplanMeierFitter()
-    kmf_global_pe.fit(df["tempo_pe_anos"], df["evento_pe"], label="Global")
+    kmf_global_pe = ajustar_km_global(
+        com_ano["tempo_pe"].to_numpy().tobytes(),
+        com_ano["evento_pe"].to_numpy().tobytes()
+    )
 
     cores = {ano: cor for ano, cor in zip(anos,
              ["tab:blue", "tab:orange", "tab:green", "tab:red"])}
 
-    def eixo_prob(ax, ylabel):
-        ax.set_xlabel("Tempo após o transplante (anos)")
-        ax.set_ylabel(ylabel)
-        ax.set_ylim(0.5, 1)
-        ax.grid(True)
-
-    def eixo_percent(ax, ylabel):
-        ax.set_xlabel("Tempo após o transplante (anos)")
-        ax.set_ylabel(ylabel)
-        ax.set_ylim(50, 100)
-        ax.yaxis.set_major_formatter(PercentFormatter(100))
-        ax.grid(True)
+    curvas_obito = [
+        (ano, *ajustar_km(estratos[ano]["tempo_obito_anos"],
+                          estratos[ano]["evento_obito"]))
+        for ano in anos
+    ]
+    curvas_pe = [
+        (ano, *ajustar_km(estratos[ano]["tempo_pe_anos"],
+                          estratos[ano]["evento_pe"]))
+        for ano in anos
+    ]
+
+    global_obito = (kmf_global_obito.survival_function_.index.to_numpy(),
+                    kmf_global_obito.survival_function_["Global"].to_numpy())
+    global_pe = (kmf_global_pe.survival_function_.index.to_numpy(),
+                 kmf_global_pe.survival_function_["Global"].to_numpy())
 
     col1, col2 = st.columns(2)
 
     with col1:
 
         st.subheader("Paciente – Probabilidade")
-        fig1, ax1 = plt.subplots()
-        kmf = KaplanMeierFitter()
-
-        for ano in anos:
-            dados = df[df["ano_tx"] == ano]
-            kmf.fit(dados["tempo_obito_anos"], dados["evento_obito"], label=str(ano))
-            kmf.plot(ax=ax1, ci_show=False, linewidth=2, color=cores.get(ano))
-
-        kmf_global_obito.plot(ax=ax1, ci_show=False,
-                              color="black", linestyle="--", linewidth=3)
-
+        fig1, ax1 = grafico_km(curvas_obito, global_obito, cores)
         eixo_prob(ax1, "Probabilidade de Sobrevida")
-        ax1.legend(title="Ano do Transplante")
-        st.pyplot(fig1)
+        exibir_figura(fig1)
 
         st.subheader("Paciente – Porcentagem")
-        fig2, ax2 = plt.subplots()
-
-        for ano in anos:
-            dados = df[df["ano_tx"] == ano]
-            kmf.fit(dados["tempo_obito_anos"], dados["evento_obito"], label=str(ano))
-            ax2.step(kmf.survival_function_.index,
-                     kmf.survival_function_[str(ano)] * 100,
-                     where="post",
-                     linewidth=2,
-                     color=cores.get(ano),
-                     label=str(ano))
-
-        ax2.step(kmf_global_obito.survival_function_.index,
-                 kmf_global_obito.survival_function_["Global"] * 100,
-                 where="post",
-                 linewidth=3,
-                 linestyle="--",
-                 color="black",
-                 label="Global")
-
+        fig2, ax2 = grafico_km(curvas_obito, global_obito, cores, escala=100)
         eixo_percent(ax2, "Sobrevida (%)")
-        ax2.legend(title="Ano do Transplante")
-        st.pyplot(fig2)
+        exibir_figura(fig2)
 
     with col2:
 
         st.subheader("Enxerto – Probabilidade")
-        fig3, ax3 = plt.subplots()
-        kmf = KaplanMeierFitter()
-
-        for ano in anos:
-            dados = df[df["ano_tx"] == ano]
-            kmf.fit(dados["tempo_pe_anos"], dados["evento_pe"], label=str(ano))
-            kmf.plot(ax=ax3, ci_show=False, linewidth=2, color=cores.get(ano))
-
-        kmf_global_pe.plot(ax=ax3, ci_show=False,
-                           color="black", linestyle="--", linewidth=3)
-
+        fig3, ax3 = grafico_km(curvas_pe, global_pe, cores)
         eixo_prob(ax3, "Probabilidade de Sobrevida do Enxerto")
-        ax3.legend(title="Ano do Transplante")
-        st.pyplot(fig3)
+        exibir_figura(fig3)
 
         st.subheader("Enxerto – Porcentagem")
-        fig4, ax4 = plt.subplots()
-
-        for ano in anos:
-            dados = df[df["ano_tx"] == ano]
-            kmf.fit(dados["tempo_pe_anos"], dados["evento_pe"], label=str(ano))
-            ax4.step(kmf.survival_function_.index,
-                     kmf.survival_function_[str(ano)] * 100,
-                     where="post",
-                     linewidth=2,
-                     color=cores.get(ano),
-                     label=str(ano))
-
-        ax4.step(kmf_global_pe.survival_function_.index,
-                 kmf_global_pe.survival_function_["Global"] * 100,
-                 where="post",
-                 linewidth=3,
-                 linestyle="--",
-                 color="black",
-                 label="Global")
-
+        fig4, ax4 = grafico_km(curvas_pe, global_pe, cores, escala=100)
         eixo_percent(ax4, "Sobrevida do Enxerto (%)")
-        ax4.legend(title="Ano do Transplante")
-        st.pyplot(fig4)
+        exibir_figura(fig4)
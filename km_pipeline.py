@@ -0,0 +1,304 @@
+"""Carga dos dados, ajustes de Kaplan-Meier, log-rank e gráficos do app."""
+from concurrent.futures import ThreadPoolExecutor
+import io
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+from matplotlib.ticker import PercentFormatter
+import numpy as np
+import pandas as pd
+import polars as pl
+import requests
+import streamlit as st
+from lifelines import KaplanMeierFitter
+from numba import njit
+from scipy.stats import chi2
+
+# st.image só precisa do PNG: simplifica os caminhos longos das curvas
+matplotlib.rcParams["path.simplify"] = True
+matplotlib.rcParams["path.simplify_threshold"] = 1.0
+matplotlib.rcParams["agg.path.chunksize"] = 10000
+
+
+@st.cache_resource(show_spinner=False)
+def sessao_http():
+    """Sessão HTTP reaproveitada entre execuções (mantém a conexão TLS)."""
+    return requests.Session()
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def ultimas_respostas():
+    """ETag e conteúdo do último download, de uma única URL.
+
+    Guardar o corpo custa uma cópia do CSV em memória além do DataFrame de
+    carregar_dados, mas é o que permite aproveitar a resposta 304; por isso
+    só a URL mais recente é mantida.
+    """
+    return {}
+
+
+def baixar_csv(url):
+    """Bytes do CSV em `url`, revalidados pelo ETag do último download."""
+    # com o ETag anterior o servidor responde 304 se o CSV não mudou
+    anteriores = ultimas_respostas()
+    cabecalhos = {}
+    if url in anteriores:
+        cabecalhos["If-None-Match"] = anteriores[url][0]
+
+    resposta = sessao_http().get(url, headers=cabecalhos, timeout=10)
+    if resposta.status_code == 304:
+        return anteriores[url][1]
+    resposta.raise_for_status()
+
+    anteriores.clear()
+    if "ETag" in resposta.headers:
+        anteriores[url] = (resposta.headers["ETag"], resposta.content)
+    return resposta.content
+
+
+def tempo_evento(datas, data_tx, censura_ns):
+    """Indicador de evento (int8) e tempo em dias (float32) desde o transplante.
+
+    Trabalha sobre os inteiros (ns) das datas: sem evento (NaT, o menor
+    int64) o tempo vai até a censura, sem materializar colunas preenchidas.
+    Sem data_tx o tempo fica ausente (NaN) em vez de estourar o int64.
+    """
+    nat = np.iinfo(np.int64).min
+    ns = datas.to_numpy().view("i8")
+    tx = data_tx.to_numpy().view("i8")
+    sem_evento = ns == nat
+    sem_tx = tx == nat
+
+    dias = (
+        np.where(sem_evento, censura_ns, ns) - np.where(sem_tx, 0, tx)
+    ) // (86_400 * 10**9)
+    # float32 representa exatamente as contagens de dias e admite NaN
+    tempo = dias.astype(np.float32)
+    tempo[sem_tx] = np.nan
+    return (~sem_evento).astype(np.int8), tempo
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def carregar_dados(fonte, data_censura):
+    colunas_data = ["data_tx", "data_obito", "data_pe"]
+    if str(fonte).startswith(("http://", "https://")):
+        fonte = io.BytesIO(baixar_csv(fonte))
+
+    # ================= TRATAMENTO DE DATAS =================
+    # Todas as colunas lidas como texto (infer_schema_length=0): colunas não
+    # usadas pelo app nunca derrubam a leitura por mudarem de tipo.
+    # Colunas de data ISO (com ou sem hora) são convertidas no Polars sem
+    # strict: valores inválidos viram nulos, como o errors="coerce" do
+    # pandas. Outros formatos (ex.: 01/02/2020) ficam com o pd.to_datetime,
+    # que lê mês/dia na mesma ordem de sempre; o Polars os leria como dia/mês.
+    bruto = pl.read_csv(fonte, infer_schema_length=0)
+    iso = [c for c in colunas_data
+           if bruto[c].drop_nulls().head(1)
+           .str.contains(r"^\d{4}-\d{2}-\d{2}").all()]
+    df = bruto.with_columns(
+        pl.col(iso).str.to_datetime(strict=False, time_unit="ns")
+    ).to_pandas()
+    for col in colunas_data:
+        if col not in iso:
+            df[col] = pd.to_datetime(df[col], errors="coerce")
+
+    df["ano_tx"] = df["data_tx"].dt.year
+
+    # ================= EVENTOS =================
+    censura_ns = data_censura.value
+
+    df["evento_obito"], df["tempo_obito"] = tempo_evento(
+        df["data_obito"], df["data_tx"], censura_ns
+    )
+    df["evento_pe"], df["tempo_pe"] = tempo_evento(
+        df["data_pe"], df["data_tx"], censura_ns
+    )
+
+    df["tempo_obito_anos"] = df["tempo_obito"].astype(np.float64) / 365.25
+    df["tempo_pe_anos"] = df["tempo_pe"].astype(np.float64) / 365.25
+
+    return df
+
+
+def matriz_logrank_pareado(tempos, grupos, eventos):
+    """p-valores do log-rank para todos os pares de grupos de uma vez.
+
+    Equivale a um logrank_test por par: a tabela de risco/eventos é montada
+    uma única vez e cada par usa só os pacientes dos dois grupos comparados.
+    Retorna os rótulos dos grupos e a matriz K x K de p-valores.
+    """
+    tempos = np.asarray(tempos, dtype=float)
+    eventos = np.asarray(eventos, dtype=float)
+    rotulos, g = np.unique(grupos, return_inverse=True)
+    t_unicos, j = np.unique(tempos, return_inverse=True)
+    n_t, n_g = len(t_unicos), len(rotulos)
+
+    celula = j * n_g + g
+    saidas = np.bincount(celula, minlength=n_t * n_g).reshape(n_t, n_g)
+    d = np.bincount(celula, weights=eventos,
+                    minlength=n_t * n_g).reshape(n_t, n_g)
+    # em risco em t_j: quem sai da observação em t_j ou depois
+    n = saidas[::-1].cumsum(axis=0)[::-1]
+
+    # eixo 1 = grupo A, eixo 2 = grupo B do par
+    n_par = n[:, :, None] + n[:, None, :]
+    d_par = d[:, :, None] + d[:, None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac = np.where(n_par > 0, n[:, :, None] / n_par, 0.0)
+        correcao = np.where(n_par > 1, (n_par - d_par) / (n_par - 1), 1.0)
+        esperado = (d_par * frac).sum(axis=0)
+        variancia = (d_par * frac * (1 - frac) * correcao).sum(axis=0)
+        # sem variância (nenhum evento no par) a estatística é 0, como no
+        # pinv usado pelo lifelines
+        estatistica = np.where(
+            variancia > 0,
+            (d.sum(axis=0)[:, None] - esperado) ** 2 / variancia,
+            0.0
+        )
+
+    return rotulos, chi2.sf(estatistica, df=1)
+
+
+def logrank_por_desfecho(com_ano):
+    """Matrizes de p-valores pareados por ano para óbito e perda de enxerto.
+
+    As duas são independentes e o NumPy libera o GIL nas operações
+    vetorizadas, então rodam em paralelo.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futuro_obito = executor.submit(
+            matriz_logrank_pareado,
+            com_ano["tempo_obito_anos"], com_ano["ano_tx"], com_ano["evento_obito"]
+        )
+        futuro_pe = executor.submit(
+            matriz_logrank_pareado,
+            com_ano["tempo_pe_anos"], com_ano["ano_tx"], com_ano["evento_pe"]
+        )
+    return futuro_obito.result()[1], futuro_pe.result()[1]
+
+
+@njit(cache=True)
+def kaplan_meier(tempos, eventos):
+    """Estimador de KM nos tempos distintos: S *= 1 - d / n a cada tempo."""
+    ordem = np.argsort(tempos)
+    t = tempos[ordem]
+    e = eventos[ordem]
+    n = t.size
+    linha = np.empty(n)
+    sobrevida = np.empty(n)
+
+    p = 1.0
+    em_risco = n
+    m = 0
+    i = 0
+    while i < n:
+        j = i
+        d = 0
+        while j < n and t[j] == t[i]:
+            d += e[j]
+            j += 1
+        p *= 1.0 - d / em_risco
+        linha[m] = t[i]
+        sobrevida[m] = p
+        m += 1
+        em_risco -= j - i
+        i = j
+
+    return linha[:m], sobrevida[:m]
+
+
+def ajustar_km(tempos, eventos):
+    """Ajusta a curva de KM e devolve (tempos, sobrevida) como arrays."""
+    linha, sobrevida = kaplan_meier(np.asarray(tempos, dtype=np.float64),
+                                    np.asarray(eventos, dtype=np.int64))
+    # como no lifelines, a curva começa em t = 0 com sobrevida 1
+    if linha.size == 0 or linha[0] > 0:
+        linha = np.concatenate(([0.0], linha))
+        sobrevida = np.concatenate(([1.0], sobrevida))
+    return linha, sobrevida
+
+
+@st.cache_resource(ttl=3600, max_entries=2, show_spinner=False)
+def ajustar_km_global(tempos_bytes, eventos_bytes):
+    """KM da coorte inteira, compartilhado entre execuções.
+
+    A chave do cache são os bytes dos tempos (dias, float32, sem ausentes)
+    e dos eventos (int8): enquanto o CSV não muda, o ajuste não é refeito.
+    Os tempos censurados mudam com a data de censura a cada dia, então o
+    cache guarda só os dois ajustes atuais (óbito e perda de enxerto).
+    """
+    tempos = np.frombuffer(tempos_bytes, dtype=np.float32).astype(np.float64)
+    tempos = tempos / 365.25
+    eventos = np.frombuffer(eventos_bytes, dtype=np.int8)
+    return KaplanMeierFitter().fit(tempos, eventos, label="Global")
+
+
+def sobrevida_em(tempos, sobrevida, horizontes):
+    """Valor da curva de KM (em degraus) em cada horizonte, por busca binária."""
+    i = np.searchsorted(tempos, horizontes, side="right") - 1
+    return sobrevida[i]
+
+
+def exibir_figura(fig):
+    # PNG gerado uma vez e figura fechada: evita o caminho de st.pyplot e
+    # não acumula figuras do pyplot entre execuções; mesma resolução que o
+    # st.pyplot usava (200 dpi)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=200, bbox_inches="tight")
+    plt.close(fig)
+    st.image(buffer.getvalue(), use_container_width=True)
+
+
+def eixo_prob(ax, ylabel):
+    ax.set_xlabel("Tempo após o transplante (anos)")
+    ax.set_ylabel(ylabel)
+    ax.set_ylim(0.5, 1)
+    ax.grid(True)
+
+
+def eixo_percent(ax, ylabel):
+    ax.set_xlabel("Tempo após o transplante (anos)")
+    ax.set_ylabel(ylabel)
+    ax.set_ylim(50, 100)
+    ax.yaxis.set_major_formatter(PercentFormatter(100))
+    ax.grid(True)
+
+
+def curvas_por_ano(ax, curvas, cores, escala=1):
+    """Desenha todas as curvas anuais (degraus) numa única coleção."""
+    segmentos, cores_curvas, legendas = [], [], []
+    for i, (ano, tempos, sobrevida) in enumerate(curvas):
+        x = np.repeat(np.asarray(tempos), 2)[1:]
+        y = np.repeat(np.asarray(sobrevida) * escala, 2)[:-1]
+        segmentos.append(np.column_stack([x, y]))
+        cores_curvas.append(cores.get(ano, f"C{i % 10}"))
+        legendas.append(Line2D([], [], color=cores_curvas[-1],
+                               linewidth=2, label=str(ano)))
+
+    ax.add_collection(LineCollection(segmentos, colors=cores_curvas,
+                                     linewidths=2, rasterized=True))
+    ax.autoscale_view()
+    return legendas
+
+
+def curva_global(ax, tempos, sobrevida, escala=1):
+    linha, = ax.step(tempos, sobrevida * escala,
+                     where="post",
+                     linewidth=3,
+                     linestyle="--",
+                     color="black",
+                     label="Global",
+                     rasterized=True)
+    return linha
+
+
+def grafico_km(curvas, coorte, cores, escala=1):
+    """Figura com as curvas por ano e a curva global (tracejada)."""
+    fig, ax = plt.subplots()
+    legendas = curvas_por_ano(ax, curvas, cores, escala)
+    linha = curva_global(ax, *coorte, escala=escala)
+    ax.legend(handles=legendas + [linha], title="Ano do Transplante")
+    return fig, ax